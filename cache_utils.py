@@ -0,0 +1,26 @@
+from __future__ import annotations
+
+import os
+import pathlib
+import tempfile
+
+CACHE_DIR = pathlib.Path(".cache")
+
+
+def read(namespace: str, key: str) -> str | None:
+    """Returns the value cached under the given namespace and key, if any."""
+    try:
+        return (CACHE_DIR / namespace / key).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+
+def write(namespace: str, key: str, value: str) -> None:
+    """Caches a value under the given namespace and key."""
+    cache_path = CACHE_DIR / namespace / key
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so concurrent readers never see a partial value
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as tmp_file:
+        tmp_file.write(value)
+    pathlib.Path(tmp_path).replace(cache_path)
@@ -1,15 +1,83 @@
 from __future__ import annotations
 
+import functools
+import hashlib
+import os
 import pathlib
+from collections.abc import Callable
 
-import pdfplumber
-from bs4 import BeautifulSoup
+import pypdfium2 as pdfium
 from docx import Document
+from selectolax.lexbor import LexborHTMLParser
 
+import cache_utils
 from print_utils import LOGGER
 
+# Set to re-extract PDFs with pdfplumber when PDFium finds no text in them
+PDF_PDFPLUMBER_FALLBACK = os.environ.get("PDF_PDFPLUMBER_FALLBACK", "0") == "1"
+
+
+def _cached(extract: Callable[[str], str]) -> Callable[[str], str]:
+    """Caches extracted text on disk, keyed by the file path, size and modification time."""
+
+    @functools.wraps(extract)
+    def wrapper(path: str) -> str:
+        stat = os.stat(path)
+        key = hashlib.sha256(
+            f"{extract.__name__}:{path}:{stat.st_mtime_ns}:{stat.st_size}".encode()
+        ).hexdigest()
+        text = cache_utils.read("text", f"{key}.txt")
+        if text is None:
+            text = extract(path)
+            cache_utils.write("text", f"{key}.txt", text)
+        else:
+            LOGGER.info(
+                f'Read {len(text)} cached chars for "{pathlib.Path(path).name[20:]}..."'
+            )
+        return text
+
+    return wrapper
+
 
 def from_pdf(pdf_path: str) -> str:
+    text = _from_pdf_pdfium(pdf_path)
+    if PDF_PDFPLUMBER_FALLBACK and not text.strip():
+        LOGGER.warning(
+            f'No text found by PDFium in "{pathlib.Path(pdf_path).name[20:]}...", retrying with pdfplumber'
+        )
+        text = _from_pdf_pdfplumber(pdf_path)
+    return text
+
+
+@_cached
+def _from_pdf_pdfium(pdf_path: str) -> str:
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        # PDFium is not thread-safe, pages are read sequentially and documents
+        # are parallelised across processes instead
+        pages = [""] * len(pdf)
+        for i in range(len(pages)):
+            # Close pages as soon as their text is read to cap memory usage
+            page = pdf[i]
+            text_page = page.get_textpage()
+            pages[i] = text_page.get_text_range()
+            text_page.close()
+            page.close()
+    finally:
+        pdf.close()
+    # PDFium separates lines with CRLF and marks soft hyphens with U+FFFE
+    text = "\n".join(pages).replace("\r\n", "\n").replace("\ufffe", "")
+    LOGGER.info(
+        f'Extracted {len(text)} chars from "{pathlib.Path(pdf_path).name[20:]}..."'
+    )
+    return text
+
+
+@_cached
+def _from_pdf_pdfplumber(pdf_path: str) -> str:
+    # Optional dependency, only needed for the fallback
+    import pdfplumber
+
     text = ""
     with pdfplumber.open(pdf_path) as pdf:
         for page in pdf.pages:
@@ -20,6 +88,7 @@ def from_pdf(pdf_path: str) -> str:
     return text
 
 
+@_cached
 def from_docx(docx_path: str) -> str:
     doc = Document(docx_path)
     text = "\n".join([para.text for para in doc.paragraphs])
@@ -29,14 +98,18 @@ def from_docx(docx_path: str) -> str:
     return text
 
 
+@_cached
 def from_html(html_path: str) -> str:
-    with open(html_path, encoding="utf-8") as file:
-        html_content = file.read()
+    html_content = pathlib.Path(html_path).read_text(encoding="utf-8", errors="replace")
 
-    soup = BeautifulSoup(html_content, "html.parser")
-    text = soup.get_text(separator="\n")
+    tree = LexborHTMLParser(html_content)
+    # Scripts and styles hold no readable text
+    for tag in tree.css("script,style,noscript"):
+        tag.decompose()
+    root = tree.body or tree.root
+    text = root.text(separator="\n") if root else ""
     LOGGER.info(
-        f'Extracted {len(text)} chars from "{pathlib.Path(html_content).name[20:]}..."'
+        f'Extracted {len(text)} chars from "{pathlib.Path(html_path).name[20:]}..."'
     )
     return text
 
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import os
 import pathlib
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import date
 
-from pydantic import BaseModel, computed_field
+import instructor
+import msgspec
+from instructor.exceptions import InstructorRetryException
+from pydantic import BaseModel, ValidatorFunctionWrapHandler, field_validator
 from pydantic_core import ValidationError
 from rich.progress import (
     BarColumn,
@@ -19,7 +22,38 @@ from rich.progress import (
 
 import extract_text
 from print_utils import CONSOLE, LOGGER
-from process_llm import ContentExtractor
+from process_llm import ContentExtractor, get_encoding, get_shared_client, throttle
+
+# Model extracting the summary of each document
+SUMMARY_MODEL = "gpt-4o-mini"
+# Upper bounds on the documents processed, and LLM requests issued, concurrently
+MAX_CONCURRENT_DOCUMENTS = 16
+MAX_CONCURRENT_REQUESTS = 8
+# Number of documents whose date ranges are extracted in a single request
+DATE_BATCH_SIZE = 32
+# Number of processes extracting text, lower it when documents sit on spinning disks
+TEXT_EXTRACTION_WORKERS = int(
+    os.environ.get("TEXT_EXTRACTION_WORKERS", os.cpu_count() or 1)
+)
+# Number of records buffered, or seconds waited for more, before the output files are written
+OUTPUT_FLUSH_EVERY = 64
+OUTPUT_FLUSH_INTERVAL = 5.0
+
+# Text extractor for each file suffix of the documents to collect
+TEXT_EXTRACTORS = {
+    ".pdf": extract_text.from_pdf,
+    ".docx": extract_text.from_docx,
+    ".html": extract_text.from_html,
+    ".htm": extract_text.from_html,
+}
+
+
+def _encode_path(path: pathlib.PurePath) -> str:
+    """Encodes paths, the only values msgspec cannot encode natively, with forward slashes."""
+    return path.as_posix()
+
+
+_JSON_ENCODER = msgspec.json.Encoder(enc_hook=_encode_path)
 
 
 class ResearchPaperSummary(BaseModel):
@@ -37,51 +71,79 @@ class ResearchPaperDates(BaseModel):
     end_date: date
 
 
-class Document(BaseModel):
+class ResearchPaperDatesWithId(BaseModel):
+    """Model to hold the start and end dates for one item of a batched request."""
+
+    id: int
+    start_date: date | None
+    end_date: date | None
+
+    @field_validator("start_date", "end_date", mode="wrap")
+    @classmethod
+    def _none_if_unparseable(
+        cls, value: object, handler: ValidatorFunctionWrapHandler
+    ) -> date | None:
+        """Maps a date that cannot be parsed to None so it does not fail the whole batch."""
+        try:
+            return handler(value)
+        except ValidationError:
+            return None
+
+
+class DateBatch(instructor.OpenAISchema):
+    """Model to hold the start and end dates extracted for a batch of items."""
+
+    items: list[ResearchPaperDatesWithId]
+
+
+class Document(msgspec.Struct):
     """Represents a document to be processed with metadata such as journal, year, and path."""
 
     journal: str
     year: int | None
     month_range: str | None
     path: pathlib.Path
+    # Derived from the path once, on construction
+    kind: str = ""
+    name: str = ""
 
-    @computed_field
-    def kind(self) -> str:
-        """Returns the file extension type of the document, e.g., PDF, DOCX."""
-        return self.path.suffix.replace(".", "").upper()
-
-    @computed_field
-    def name(self) -> str:
-        """Returns the name of the document."""
-        return str(self.path.name)
+    def __post_init__(self):
+        """Sets the file extension type of the document, e.g., PDF, DOCX, and its name."""
+        self.kind = self.path.suffix[1:].upper()
+        self.name = self.path.name
 
     def read_text(self) -> str | None:
         """Reads and extracts text content from the document based on its type."""
-        str_path = str(self.path)
         # Extract text based on document type
-        match self.kind:
-            case "PDF":
-                return extract_text.from_pdf(str_path)
-            case "DOCX":
-                return extract_text.from_docx(str_path)
-            case "HTML":
-                return extract_text.from_html(str_path)
-            case "HTM":
-                return extract_text.from_html(str_path)
-        return None
+        extractor = TEXT_EXTRACTORS.get(self.path.suffix.lower())
+        return extractor(str(self.path)) if extractor else None
 
 
-class DocumentList(BaseModel):
+class DocumentList(msgspec.Struct):
     """Model to hold a list of Document instances."""
 
     docs: list[Document]
 
 
+class ProcessedDocument(msgspec.Struct):
+    """Model to hold the fields of documents_success.jsonl needed to resume processing."""
+
+    path: str
+
+
+# Only decodes the path of each line, skipping over the extracted content
+_PROCESSED_DOCUMENT_DECODER = msgspec.json.Decoder(ProcessedDocument)
+
+
 def _collect_documents() -> DocumentList:
     """Collects documents from the 'data' directory and returns a DocumentList."""
     documents = []
-    for pattern in ["**/*.pdf", "**/*.htm*", "**/*.docx"]:
-        for path in pathlib.Path("data").glob(pattern):
+    # Walk the tree once and classify files by suffix, rather than once per glob
+    for root, _, files in os.walk("data"):
+        for file in files:
+            if os.path.splitext(file)[1].lower() not in TEXT_EXTRACTORS:
+                continue
+            path = pathlib.Path(root, file)
             # Determine document metadata based on directory structure
             if len(path.parts) == 6:
                 *_, journal, year, month_range, _ = path.parts
@@ -101,7 +163,9 @@ def _collect_documents() -> DocumentList:
     return DocumentList(docs=documents)
 
 
-def _get_research_paper_content(content: str) -> ResearchPaperSummary | None:
+async def _get_research_paper_content(
+    content: str, semaphore: asyncio.Semaphore | None = None, label: str = "document"
+) -> ResearchPaperSummary | None:
     """Extracts research paper content including authors, title, and abstract."""
     extractor = ContentExtractor(
         content=content,
@@ -115,54 +179,146 @@ def _get_research_paper_content(content: str) -> ResearchPaperSummary | None:
             {fields_to_extract}
             Provide the results in JSON format with keys: {json_keys}.
             """,
-        model="gpt-4o-mini",
+        model=SUMMARY_MODEL,
         base_url=None,
-        chunk_step=300,
+        # Size the windows in tokens, about the 3000 and 1500 words used otherwise
+        head_tokens=4000,
+        tail_tokens=2000,
+        semaphore=semaphore,
+        label=label,
     )
     try:
-        return extractor.extract_information()
+        return await extractor.extract_information()
     except ValidationError:
         # Return None if the validation of extracted content fails
         return None
 
 
-def _get_date_range_metadata(content: str) -> ResearchPaperDates | None:
-    """Extracts start and end dates from the document content."""
-    extractor = ContentExtractor(
-        content=content,
-        prompt_template="""
-        **Fields to extract from document:**
-        {fields_to_extract}
-
-        <document>
-        {chunk}
-        </document>
+async def _get_date_ranges_batch(
+    docs: list[Document],
+    semaphore: asyncio.Semaphore | None = None,
+    client: instructor.AsyncInstructor = None,
+) -> list[ResearchPaperDates | None]:
+    """Extracts start and end dates for a batch of documents in a single request."""
+    # Documents from the same journal issue share their year and month range,
+    # documents without either have nothing to extract dates from
+    keys = [
+        key
+        for key in dict.fromkeys((doc.year, doc.month_range) for doc in docs)
+        if key != (None, None)
+    ]
+    if not keys:
+        return [None] * len(docs)
+    items = [
+        {"id": i, "year": year, "month_range": month_range}
+        for i, (year, month_range) in enumerate(keys)
+    ]
+    prompt = f"""
+        **Items to extract dates from:**
+        {msgspec.json.encode(items).decode()}
 
         **Instructions:**
-        Extract the `start_date` and `end_date` from the provided document. Ensure that:
+        For each of the items, extract the `start_date` and `end_date` from its `year` and `month_range`. Ensure that:
         - Dates are in the `YYYY-MM-DD` format.
         - `start_date` represents the first day of the starting month.
         - `end_date` represents the last day of the ending month.
         - If only a single month is provided, both `start_date` and `end_date` should correspond to that month.
+        - Each result keeps the `id` of the item it was extracted from.
+        - If the dates of an item cannot be determined, set its `start_date` and `end_date` to `null`.
 
         **Output Format:**
-        Provide the results in JSON format ({json_keys}) adhering to the `PaperDates` model:
+        Provide the results in JSON format adhering to the `DateBatch` model:
         ```json
         {{
-            "start_date": "YYYY-MM-DD",
-            "end_date": "YYYY-MM-DD"
+            "items": [
+                {{
+                    "id": 0,
+                    "start_date": "YYYY-MM-DD",
+                    "end_date": "YYYY-MM-DD"
+                }}
+            ]
         }}
-        """,
-        response_model=ResearchPaperDates,
-        model="gpt-4o-mini",
-        base_url=None,
-        chunk_step=30,
-    )
+        """
+
+    client = client or get_shared_client(None, None)
     try:
-        return extractor.extract_information()
-    except ValidationError:
-        # Return None if the validation of extracted dates fails
-        return None
+        async with semaphore or asyncio.Semaphore(1):
+            await throttle(prompt)
+            resp = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}],
+                response_model=DateBatch,
+                max_retries=10,
+            )
+    except (ValidationError, InstructorRetryException) as e:
+        if len(keys) == 1:
+            # Return no dates if the validation of extracted dates fails
+            return [None] * len(docs)
+        # Request each key on its own so one bad key does not fail the whole batch
+        LOGGER.warning(f"Date batch failed, retrying its items one by one: {e}")
+        key_dates = await asyncio.gather(
+            *(
+                _get_date_ranges_batch(
+                    [doc for doc in docs if (doc.year, doc.month_range) == key],
+                    semaphore,
+                    client,
+                )
+                for key in keys
+            )
+        )
+        dates_by_key = {
+            key: dates[0] for key, dates in zip(keys, key_dates, strict=True)
+        }
+    else:
+        dates_by_key = {
+            keys[item.id]: ResearchPaperDates(
+                start_date=item.start_date, end_date=item.end_date
+            )
+            for item in resp.items
+            if 0 <= item.id < len(keys) and item.start_date and item.end_date
+        }
+    return [dates_by_key.get((doc.year, doc.month_range)) for doc in docs]
+
+
+async def _write_outputs(output_queue: asyncio.Queue) -> None:
+    """Appends the (status, line) records from the queue to the output files until a None record."""
+    with (
+        open("documents_success.jsonl", "ab") as success_file,
+        open("documents_failed.jsonl", "ab") as failed_file,
+    ):
+        output_files = {"success": success_file, "failed": failed_file}
+        buffered_lines = {"success": [], "failed": []}
+        buffered = 0
+
+        def _flush():
+            """Writes out the buffered lines of each file in a single call."""
+            nonlocal buffered
+            for status, lines in buffered_lines.items():
+                if lines:
+                    output_files[status].writelines(lines)
+                    output_files[status].flush()
+                    lines.clear()
+            buffered = 0
+
+        try:
+            while True:
+                try:
+                    record = await asyncio.wait_for(
+                        output_queue.get(), OUTPUT_FLUSH_INTERVAL
+                    )
+                except TimeoutError:
+                    # Don't hold records back while documents are slow to finish
+                    _flush()
+                    continue
+                if record is None:
+                    break
+                status, line = record
+                buffered_lines[status].append(line)
+                buffered += 1
+                if buffered >= OUTPUT_FLUSH_EVERY:
+                    _flush()
+        finally:
+            _flush()
 
 
 if __name__ == "__main__":
@@ -173,18 +329,17 @@ if __name__ == "__main__":
     # Load already processed documents from documents_success.jsonl
     already_processed_docs = set()
     try:
-        with open("documents_success.jsonl") as success_file:
-            for line in success_file:
-                processed_doc = json.loads(line)
-                already_processed_docs.add(processed_doc["path"])
+        with open("documents_success.jsonl", "rb") as success_file:
+            already_processed_docs = {
+                processed_doc.path
+                for processed_doc in _PROCESSED_DOCUMENT_DECODER.decode_lines(
+                    success_file.read()
+                )
+            }
     except FileNotFoundError:
         # If the file does not exist, skip loading and start fresh
         pass
 
-    # Initialize locks for file writing
-    success_file_lock = threading.Lock()
-    failed_file_lock = threading.Lock()
-
     with Progress(
         SpinnerColumn(),
         BarColumn(),
@@ -199,93 +354,160 @@ if __name__ == "__main__":
             f"Processed 0/{total_docs} documents", total=total_docs
         )
 
-        def _process_document(
+        def _advance_progress(progress, task_id):
+            """Advances the progress bar by one processed document."""
+            progress.update(
+                task_id,
+                advance=1,
+                description=f"Processed {progress.tasks[task_id].completed}/{progress.tasks[task_id].total} documents",
+            )
+
+        def _write_failed(doc: Document, output_queue: asyncio.Queue):
+            """Queues a document to be recorded as failed."""
+            output_queue.put_nowait(("failed", _JSON_ENCODER.encode(doc) + b"\n"))
+
+        async def _extract_document(
             doc: Document,
             progress,
             task_id,
-            success_file_lock,
-            failed_file_lock,
+            text_executor: Executor,
+            output_queue: asyncio.Queue,
+            document_semaphore: asyncio.Semaphore,
+            request_semaphore: asyncio.Semaphore,
+        ) -> ResearchPaperSummary | None:
+            """Extracts the text and content of a document, recording it as failed if either is missing."""
+            async with document_semaphore:
+                try:
+                    # Parsing is CPU bound, so it runs outside of the event loop process
+                    text_data = await asyncio.get_running_loop().run_in_executor(
+                        text_executor, doc.read_text
+                    )
+                    # Fail before any LLM request is spent on the document
+                    if not text_data or len(text_data) < 100:
+                        LOGGER.error(
+                            f'Skipping since minimal text content extracted from "{doc.name}"'
+                        )
+                        raise FileNotFoundError()
+                    summary = await _get_research_paper_content(
+                        text_data, request_semaphore, doc.name
+                    )
+                    if summary is None:
+                        raise ValidationError()
+                    return summary
+                except ValidationError:
+                    # Handle validation error during extraction
+                    LOGGER.error(f"Validation error for document {doc}")
+                except Exception as e:
+                    # Handle any unexpected errors during processing
+                    LOGGER.error(f"Unexpected error for document {doc}: {e}")
+            _write_failed(doc, output_queue)
+            _advance_progress(progress, task_id)
+            return None
+
+        async def _process_batch(
+            batch: list[Document],
+            progress,
+            task_id,
+            text_executor: Executor,
+            output_queue: asyncio.Queue,
+            document_semaphore: asyncio.Semaphore,
+            request_semaphore: asyncio.Semaphore,
         ):
-            """Processes an individual document by extracting metadata and content."""
-            if str(doc.path) in already_processed_docs:
-                # Skip processing if the document has already been processed
-                LOGGER.info(
-                    f"Document '{doc.path.name}' has already been processed. Skipping."
-                )
-                # Update progress
-                progress.update(
-                    task_id,
-                    advance=1,
-                    description=f"Processed {progress.tasks[task_id].completed}/{progress.tasks[task_id].total} documents",
-                )
+            """Extracts the content of a batch of documents, then the date ranges of those that succeeded at once."""
+            summaries = await asyncio.gather(
+                *[
+                    _extract_document(
+                        doc,
+                        progress,
+                        task_id,
+                        text_executor,
+                        output_queue,
+                        document_semaphore,
+                        request_semaphore,
+                    )
+                    for doc in batch
+                ]
+            )
+            extracted = [
+                (doc, summary)
+                for doc, summary in zip(batch, summaries, strict=True)
+                if summary is not None
+            ]
+            if not extracted:
                 return
 
             try:
-                # Extract dates and content from the document
-                dates = _get_date_range_metadata(
-                    doc.model_dump_json(include={"year", "month_range"})
+                dates = await _get_date_ranges_batch(
+                    [doc for doc, _ in extracted], request_semaphore
                 )
-                text_data = doc.read_text()
-                if not text_data or len(text_data) < 100:
-                    LOGGER.error(
-                        f'Skipping since minimal text content extracted from "{doc.name}"'
-                    )
-                    raise FileNotFoundError()
+            except Exception as e:
+                # Let every document of the batch be recorded as failed
+                LOGGER.error(f"Unexpected error extracting dates for batch: {e}")
+                dates = [None] * len(extracted)
+
+            for (doc, summary), doc_dates in zip(extracted, dates, strict=True):
+                if doc_dates is None:
+                    LOGGER.error(f"No date range extracted for document {doc}")
+                    _write_failed(doc, output_queue)
                 else:
-                    summary = _get_research_paper_content(text_data)
-                    if summary is None:
-                        raise ValidationError()
                     processed_doc = (
-                        doc.model_dump(mode="json")
+                        msgspec.to_builtins(doc, enc_hook=_encode_path)
                         | summary.model_dump()
-                        | dates.model_dump(mode="json")
+                        | doc_dates.model_dump(mode="json")
                     )
-                    with (
-                        success_file_lock,
-                        open("documents_success.jsonl", "a") as success_file,
-                    ):
-                        success_file.write(json.dumps(processed_doc) + "\n")
-            except ValidationError:
-                # Handle validation error during extraction
-                LOGGER.error(f"Validation error for document {doc}")
-                failed_doc = doc.model_dump(mode="json")
-                with (
-                    failed_file_lock,
-                    open("documents_failed.jsonl", "a") as failed_file,
-                ):
-                    failed_file.write(json.dumps(failed_doc) + "\n")
-            except Exception as e:
-                # Handle any unexpected errors during processing
-                LOGGER.error(f"Unexpected error for document {doc}: {e}")
-                failed_doc = doc.model_dump(mode="json")
-                with (
-                    failed_file_lock,
-                    open("documents_failed.jsonl", "a") as failed_file,
-                ):
-                    failed_file.write(json.dumps(failed_doc) + "\n")
-            finally:
-                # Update progress
-                progress.update(
-                    task_id,
-                    advance=1,
-                    description=f"Processed {progress.tasks[task_id].completed}/{progress.tasks[task_id].total} documents",
-                )
+                    output_queue.put_nowait(
+                        (
+                            "success",
+                            _JSON_ENCODER.encode(processed_doc) + b"\n",
+                        )
+                    )
+                _advance_progress(progress, task_id)
+
+        async def _process_documents():
+            """Processes all documents concurrently on a single event loop."""
+            pending_docs = []
+            for doc in docs:
+                if doc.path.as_posix() in already_processed_docs:
+                    # Skip processing if the document has already been processed
+                    LOGGER.info(
+                        f"Document '{doc.path.name}' has already been processed. Skipping."
+                    )
+                    _advance_progress(progress, task)
+                else:
+                    pending_docs.append(doc)
 
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = [
-                executor.submit(
-                    _process_document,
-                    doc,
-                    progress,
-                    task,
-                    success_file_lock,
-                    failed_file_lock,
-                )
-                for doc in docs
-            ]
-            # Wait for all futures to complete
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    LOGGER.error(f"Error processing document: {e}")
+            document_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOCUMENTS)
+            request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+            # A single writer owns the output files, so no file locks are needed
+            output_queue = asyncio.Queue()
+            writer = asyncio.create_task(_write_outputs(output_queue))
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=TEXT_EXTRACTION_WORKERS
+                ) as text_executor:
+                    results = await asyncio.gather(
+                        *[
+                            _process_batch(
+                                pending_docs[i : i + DATE_BATCH_SIZE],
+                                progress,
+                                task,
+                                text_executor,
+                                output_queue,
+                                document_semaphore,
+                                request_semaphore,
+                            )
+                            for i in range(0, len(pending_docs), DATE_BATCH_SIZE)
+                        ],
+                        return_exceptions=True,
+                    )
+            finally:
+                output_queue.put_nowait(None)
+                await writer
+            for result in results:
+                if isinstance(result, Exception):
+                    LOGGER.error(f"Error processing document: {result}")
+
+        # Load the tokenizer up front, as tiktoken may download it, which would
+        # otherwise block the event loop
+        get_encoding(SUMMARY_MODEL)
+        asyncio.run(_process_documents())
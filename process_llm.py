@@ -1,13 +1,113 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import string
 import time
+import typing
 
+import httpx
 import instructor
-from openai import OpenAI
-from pydantic import BaseModel, ValidationError
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI
+from pydantic import BaseModel, ValidationError, create_model
 
+import cache_utils
 from print_utils import CONSOLE, LOGGER
 
+# Request and token budgets per minute, set just under the account's rate limits
+REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 450))
+TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 180_000))
+
+# Shared by every request so concurrent extractors stay within the budgets together
+_REQUEST_LIMITER = AsyncLimiter(REQUESTS_PER_MINUTE, time_period=60)
+_TOKEN_LIMITER = AsyncLimiter(TOKENS_PER_MINUTE, time_period=60)
+
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimates the number of tokens in a text, at four characters per token."""
+    return len(text) // 4 + 1
+
+
+@functools.cache
+def get_encoding(model: str):
+    """Returns the tiktoken encoding of the model, or None if it is unavailable."""
+    # tiktoken is optional, so falling back to words is the normal case without it
+    try:
+        import tiktoken
+    except ImportError:
+        LOGGER.debug("tiktoken is not installed, sizing windows by words instead")
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Models tiktoken does not know, such as those served by Ollama
+        LOGGER.debug(
+            f"No tokenizer known for '{model}', sizing windows by words instead"
+        )
+    except (OSError, ValueError) as e:
+        # The encoding is downloaded and checked on first use, which fails offline
+        LOGGER.warning(f"Could not load the tokenizer of '{model}': {e}")
+    return None
+
+
+@functools.cache
+def _required_fields(response_model: type[BaseModel]) -> tuple[str, ...]:
+    """Returns the fields of the response model that cannot be None, in model order."""
+    return tuple(
+        name
+        for name, field in response_model.model_fields.items()
+        if field.annotation is not type(None)
+        and type(None) not in typing.get_args(field.annotation)
+    )
+
+
+@functools.cache
+def _partial_model(
+    response_model: type[BaseModel], fields: tuple[str, ...]
+) -> type[BaseModel]:
+    """Returns a model holding only the given fields of the response model."""
+    # Only the field definitions are copied, class-level validators of the response
+    # model are not carried over and only run when the full model is validated
+    # Based on instructor's schema class, so instructor uses it as is instead of
+    # wrapping it in a new class on every request
+    return create_model(
+        f"{response_model.__name__}Partial",
+        __base__=instructor.OpenAISchema,
+        **{
+            field: (
+                response_model.model_fields[field].annotation,
+                response_model.model_fields[field],
+            )
+            for field in fields
+        },
+    )
+
+
+@functools.cache
+def _schema_key(response_model: type[BaseModel]) -> str:
+    """Returns the response model's JSON schema as a canonical string, for cache keys."""
+    return json.dumps(response_model.model_json_schema(), sort_keys=True)
+
+
+@functools.cache
+def _field_prompt_values(fields: tuple[str, ...]) -> dict[str, str]:
+    """Returns the prompt placeholder values that list the fields to extract."""
+    return {
+        "fields_to_extract": "\n".join(f"- {field.capitalize()}" for field in fields),
+        "json_keys": ", ".join(fields),
+    }
+
+
+async def throttle(prompt: str) -> None:
+    """Waits until a request with the given prompt fits within the rate limits."""
+    await _REQUEST_LIMITER.acquire()
+    await _TOKEN_LIMITER.acquire(min(estimate_tokens(prompt), TOKENS_PER_MINUTE))
+
 
 class ContentExtractor:
     def __init__(
@@ -15,136 +115,254 @@ class ContentExtractor:
         content: str,
         prompt_template: str,
         response_model: BaseModel,
-        client: instructor.Client = None,
+        client: instructor.AsyncInstructor = None,
         model: str = "llama3.2",
-        chunk_step: int = 75,
-        max_chunks: int = 20,
+        head_words: int = 3000,
+        tail_words: int = 1500,
+        head_tokens: int | None = None,
+        tail_tokens: int = 2000,
         max_retries: int = 10,
+        request_timeout: float = 20.0,
+        max_concurrency: int = 8,
+        semaphore: asyncio.Semaphore | None = None,
         base_url: str = "http://localhost:11434/v1",
         api_key: str = "default_api_key",
+        label: str = "document",
+        cache_responses: bool = True,
     ):
         self.content = content
-        self.client = client or self.create_default_client(base_url, api_key)
+        # Names the document in log messages, which interleave across documents
+        self.label = label
+        self.client = client or get_shared_client(base_url, api_key)
         self.response_model = response_model
         self.model = model
         self.extraction_prompt_template = prompt_template
-        self.chunk_step = chunk_step
-        self.max_chunks = max_chunks
+        # Parse the template once into literal pieces and the slots between them,
+        # so rendering a prompt only fills the slots and joins
+        self._prompt_pieces = []
+        self._prompt_slots = []
+        for literal_text, field_name, _, _ in string.Formatter().parse(prompt_template):
+            self._prompt_pieces.append(literal_text)
+            if field_name is not None:
+                self._prompt_slots.append((len(self._prompt_pieces), field_name))
+                self._prompt_pieces.append("")
+        self.head_words = head_words
+        self.tail_words = tail_words
+        # When set, windows are cut by the model's tokenizer rather than by words, so
+        # they fill a known share of the context however dense the text is; models
+        # without a known tokenizer fall back to the word windows
+        self.head_tokens = head_tokens
+        self.tail_tokens = tail_tokens
         self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        # Caps the number of in-flight LLM requests; pass a shared semaphore to
+        # bound concurrency across several extractors
+        self.semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+        # Reuse responses to identical prompts from earlier runs instead of re-requesting them
+        self.cache_responses = cache_responses
         self.console = CONSOLE  # Use the shared console
-        self.words = self.content.split()
-        self.total_words = len(self.words)
 
         # Initialize a dictionary to store extracted fields
         self.extracted_data = {k: None for k in self.response_model.model_fields}
 
     @staticmethod
-    def create_default_client(base_url: str, api_key: str) -> instructor.Client:
+    def create_default_client(
+        base_url: str, api_key: str, request_timeout: float = 20.0
+    ) -> instructor.AsyncInstructor:
+        # Keep connections alive between requests, and fail stuck requests so the
+        # OpenAI client retries them instead of stalling the whole document
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_keepalive_connections=32, max_connections=64, keepalive_expiry=120
+            ),
+            timeout=httpx.Timeout(
+                connect=5.0, read=request_timeout, write=10.0, pool=5.0
+            ),
+        )
         open_ai = (
-            OpenAI(
+            AsyncOpenAI(
                 base_url=base_url,
                 api_key=api_key,
+                http_client=http_client,
             )
             if base_url
-            else OpenAI()
+            else AsyncOpenAI(http_client=http_client)
         )
 
         return instructor.from_openai(open_ai, mode=instructor.Mode.JSON)
 
-    def _get_cumulative_chunk(self, current_step: int) -> str:
-        """Returns the cumulative chunk up to the current step, ensuring it does not exceed the total length."""
-        end = min(self.chunk_step * current_step, self.total_words)
-        return " ".join(self.words[:end])
-
-    def extract_information(self) -> BaseModel | None:
-        overall_start_time = time.time()
-        fields = {
-            k
-            for k, v in self.response_model.model_fields.items()
-            if "None" not in str(v.annotation)
-        }
+    def _get_windows(self) -> list[tuple[str, str]]:
+        """Returns the labelled windows of the document to extract from, in order."""
+        encoding = self.head_tokens and get_encoding(self.model)
+        if encoding:
+            return self._get_token_windows(encoding)
+        # Only split off the words each window needs instead of the whole document
+        head_split = self.content.split(maxsplit=self.head_words)
+        windows = [("head", " ".join(head_split[: self.head_words]))]
+        # The tail is only requested for fields still missing after the head, and
+        # is taken from the words after it so no word is sent twice
+        if len(head_split) > self.head_words:
+            tail_split = head_split[-1].rsplit(maxsplit=self.tail_words)
+            windows.append(("tail", " ".join(tail_split[-self.tail_words :])))
+        return windows
 
-        for step in range(1, self.max_chunks + 1):
-            current_chunk_size = self.chunk_step * step
-            chunk = self._get_cumulative_chunk(step)
+    def _get_token_windows(self, encoding) -> list[tuple[str, str]]:
+        """Returns the labelled head and tail windows of the document, sized in tokens."""
+        tokens = encoding.encode_ordinary(self.content)
+        windows = [("head", encoding.decode(tokens[: self.head_tokens]))]
+        if len(tokens) > self.head_tokens:
+            tail_start = max(self.head_tokens, len(tokens) - self.tail_tokens)
+            windows.append(("tail", encoding.decode(tokens[tail_start:])))
+        return windows
 
-            missing_fields = [
-                field for field in fields if self.extracted_data[field] is None
-            ]
+    def _render_prompt(self, **values: str) -> str:
+        """Renders the pre-parsed prompt template with the given placeholder values."""
+        pieces = self._prompt_pieces.copy()
+        for index, field_name in self._prompt_slots:
+            pieces[index] = values[field_name]
+        return "".join(pieces)
 
-            if not missing_fields:
-                break
+    def _get_missing_fields(self, fields: tuple[str, ...]) -> list[str]:
+        return [field for field in fields if self.extracted_data[field] is None]
 
-            # Create dynamic prompt based on missing fields
-            fields_to_extract_str = "\n".join(
-                f"- {field.capitalize()}" for field in missing_fields
-            )
-            json_keys_str = ", ".join(missing_fields)
+    async def _cached_create(
+        self, prompt: str, response_model: type[BaseModel]
+    ) -> BaseModel:
+        """Requests a response to the prompt, reusing a cached one for the same model, schema and prompt."""
+        key = hashlib.sha256(
+            f"{self.model}|{_schema_key(response_model)}|{prompt}".encode()
+        ).hexdigest()
+        if self.cache_responses:
+            cached = cache_utils.read("llm", f"{key}.json")
+            if cached is not None:
+                try:
+                    resp = response_model.model_validate_json(cached)
+                except ValidationError:
+                    # Request again rather than failing on a stale or corrupt entry
+                    LOGGER.warning("Ignoring invalid cached response %s", key)
+                else:
+                    LOGGER.debug("Using cached response %s", key)
+                    return resp
 
-            extraction_prompt = self.extraction_prompt_template.format(
-                chunk=chunk,
-                fields_to_extract=fields_to_extract_str,
-                json_keys=json_keys_str,
+        async with self.semaphore:
+            await throttle(prompt)
+            resp = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                response_model=response_model,
+                max_retries=self.max_retries,
+                timeout=self.request_timeout,
             )
+        # Only cache complete answers, so a document that failed gets a fresh answer
+        # on the next run instead of replaying the same empty fields
+        if self.cache_responses and all(
+            getattr(resp, field) for field in response_model.model_fields
+        ):
+            cache_utils.write("llm", f"{key}.json", resp.model_dump_json())
+        return resp
 
-            chunk_start_time = time.time()
-
-            try:
-                resp = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": extraction_prompt,
-                        }
-                    ],
-                    response_model=self.response_model,
-                    max_retries=self.max_retries,
-                )
-                LOGGER.debug(f"Response: {resp}")
-            except ValidationError as e:
-                LOGGER.warning(f"Validation error: {e}")
-                continue
+    async def _extract_window(
+        self, window_label: str, window: str, missing_fields: list[str]
+    ) -> BaseModel | None:
+        """Requests the missing fields from a single window of the document."""
+        # Create dynamic prompt based on missing fields, which only change as
+        # fields are extracted
+        extraction_prompt = self._render_prompt(
+            chunk=window, **_field_prompt_values(tuple(missing_fields))
+        )
 
-            chunk_end_time = time.time()
-            elapsed_time = chunk_end_time - chunk_start_time
+        window_start_ns = time.perf_counter_ns()
+        try:
+            # Only ask for, and validate, the fields still missing
+            resp = await self._cached_create(
+                extraction_prompt,
+                _partial_model(self.response_model, tuple(missing_fields)),
+            )
+            # Logged lazily, since responses are only dumped when debugging
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("Response: %s", resp.model_dump_json())
+        except ValidationError as e:
+            LOGGER.warning("Validation error: %s", e)
+            return None
 
+        if LOGGER.isEnabledFor(logging.INFO):
             LOGGER.info(
-                f"Chunk of size {current_chunk_size} processed in {elapsed_time:.2f} seconds."
+                "Processed %s of '%s' in %.2f seconds.",
+                window_label,
+                self.label,
+                (time.perf_counter_ns() - window_start_ns) / 1e9,
             )
+        return resp
 
-            # Update extracted data with any new fields
-            for field in missing_fields:
-                value = getattr(resp, field, None)
-                if value:
-                    self.extracted_data[field] = value
-                    LOGGER.info(
-                        f"Extracted '{field}' at chunk size {current_chunk_size} words."
-                    )
-
-            overall_end_time = time.time()
-            total_elapsed = overall_end_time - overall_start_time
-
-            # Check if all fields have been extracted
-            if all(self.extracted_data.values()):
+    def _merge_response(
+        self, window_label: str, resp: BaseModel | None, missing_fields: list[str]
+    ) -> None:
+        """Updates extracted data with any new fields of a window's response."""
+        if resp is None:
+            return
+        # Only the fields the LLM actually set, so defaults never count as extracted.
+        # Values are kept as validated rather than dumped, so nested models stay
+        # models when the result is assembled
+        for field in missing_fields:
+            if field not in resp.model_fields_set:
+                continue
+            value = getattr(resp, field)
+            if value and self.extracted_data[field] is None:
+                self.extracted_data[field] = value
                 LOGGER.info(
-                    f"Successfully extracted all required information in {total_elapsed:.2f} seconds."
+                    "Extracted '%s' from %s of '%s'.", field, window_label, self.label
                 )
-                return self.response_model(**self.extracted_data)
 
-        # After the loop ends, check if all fields have been extracted
-        if all(self.extracted_data.values()):
+    async def extract_information(self) -> BaseModel | None:
+        overall_start_ns = time.perf_counter_ns()
+        fields = _required_fields(self.response_model)
+
+        # The tail is only requested for fields still missing after the head
+        for window_label, window in self._get_windows():
+            missing_fields = self._get_missing_fields(fields)
+            if not missing_fields:
+                break
+            resp = await self._extract_window(window_label, window, missing_fields)
+            self._merge_response(window_label, resp, missing_fields)
+
+        total_elapsed = (time.perf_counter_ns() - overall_start_ns) / 1e9
+
+        # Check if all required fields have been extracted
+        missing_fields = self._get_missing_fields(fields)
+        if not missing_fields:
             LOGGER.info(
-                f"Successfully extracted all required information after processing all chunks in {total_elapsed:.2f} seconds."
+                f"Successfully extracted all required information from '{self.label}' in {total_elapsed:.2f} seconds."
             )
         else:
-            missing_fields = [
-                field for field in fields if self.extracted_data[field] is None
-            ]
             LOGGER.error(
-                f"Failed to extract all required information within the maximum chunk size after {total_elapsed:.2f} seconds."
+                f"Failed to extract all required information from the head and tail of '{self.label}' after {total_elapsed:.2f} seconds."
             )
-            LOGGER.error(f"Missing fields: {missing_fields}")
+            LOGGER.error(f"Missing fields of '{self.label}': {missing_fields}")
 
-        # Return the partially filled model or None
-        return self.response_model(**self.extracted_data)
+        # Validate once, so the response model's own validators run; raises a
+        # ValidationError naming any missing fields
+        return self.response_model.model_validate(self.extracted_data)
+
+
+# Clients by endpoint and key, so extractors for the same endpoint share a connection pool
+_CLIENTS: dict[tuple[str | None, str | None], instructor.AsyncInstructor] = {}
+
+
+def get_shared_client(
+    base_url: str | None, api_key: str | None
+) -> instructor.AsyncInstructor:
+    """Returns the client shared by all extractors using the given endpoint and key."""
+    # Without a base URL the client reads the OpenAI endpoint and key from the
+    # environment and ignores the given key, so all such callers share one client
+    key = (base_url, api_key if base_url else None)
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = _CLIENTS[key] = ContentExtractor.create_default_client(
+            base_url, api_key
+        )
+    return client
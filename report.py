@@ -1,14 +1,64 @@
 from __future__ import annotations
 
+import os
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as paj
+
+# Columns of the document written on every line of both output files
+DOCUMENT_SCHEMA = pa.schema(
+    {
+        "journal": pa.string(),
+        "year": pa.int64(),
+        "month_range": pa.string(),
+        "path": pa.string(),
+        "kind": pa.string(),
+        "name": pa.string(),
+    }
+)
+# Columns of successfully processed documents; declared up front since columns
+# that are null in the first lines otherwise fail to parse once values appear
+SUCCESS_SCHEMA = pa.schema(
+    [
+        *DOCUMENT_SCHEMA,
+        pa.field("authors", pa.list_(pa.string())),
+        pa.field("title", pa.string()),
+        pa.field("abstract", pa.string()),
+        pa.field("start_date", pa.string()),
+        pa.field("end_date", pa.string()),
+    ]
+)
+
+
+def _read_jsonl(path: str, schema: pa.Schema) -> pa.Table:
+    """Reads a JSON Lines file into an Arrow table with the given schema."""
+    # Arrow rejects empty files, which runs without failures leave behind
+    if os.path.getsize(path) == 0:
+        return schema.empty_table()
+    return paj.read_json(path, parse_options=paj.ParseOptions(explicit_schema=schema))
+
 
 if __name__ == "__main__":
-    success_df = pd.read_json("documents_success.jsonl", lines=True).assign(
-        start_date=lambda df: pd.to_datetime(df["start_date"], errors="coerce"),
-        end_date=lambda df: pd.to_datetime(df["end_date"], errors="coerce"),
+    success_table = _read_jsonl("documents_success.jsonl", SUCCESS_SCHEMA)
+    # Parse the dates with the format the extraction prompt enforces, leaving
+    # malformed dates empty
+    for column in ("start_date", "end_date"):
+        success_table = success_table.set_column(
+            success_table.schema.get_field_index(column),
+            column,
+            pc.strptime(
+                success_table[column], format="%Y-%m-%d", unit="s", error_is_null=True
+            ),
+        )
+    success_df = success_table.to_pandas(types_mapper=pd.ArrowDtype)
+    failure_df = _read_jsonl("documents_failed.jsonl", DOCUMENT_SCHEMA).to_pandas(
+        types_mapper=pd.ArrowDtype
     )
-    failure_df = pd.read_json("documents_failed.jsonl", lines=True)
 
-    with pd.ExcelWriter("documents_combined.xlsx", engine="openpyxl") as writer:
+    # xlsxwriter serializes sheets faster than openpyxl; its constant_memory mode is
+    # left off since pandas writes cells column by column, which that mode drops
+    with pd.ExcelWriter("documents_combined.xlsx", engine="xlsxwriter") as writer:
         success_df.to_excel(writer, sheet_name="processed_docs", index=False)
         failure_df.to_excel(writer, sheet_name="failures", index=False)